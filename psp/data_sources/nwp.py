@@ -7,6 +7,7 @@ from typing import Optional
 # This import registers a codec.
 import ocf_blosc2  # noqa
 import xarray as xr
+import zarr
 
 from psp.data_sources.utils import _STEP, _TIME, _VALUE, _VARIABLE, _X, _Y, slice_on_lat_lon
 from psp.gis import CoordinateTransformer
@@ -41,6 +42,7 @@ class NwpDataSource:
         tolerance: Optional[str] = None,
         variables: Optional[list[str]] = None,
         filter_on_step: Optional[bool] = True,
+        store_cache_size: int | None = None,
     ):
         """
         Arguments:
@@ -64,17 +66,16 @@ class NwpDataSource:
         nwp_tolerance: How old should the NWP predictions be before we start ignoring them.
             See `NwpDataSource.get`'s documentation for details..
         nwp_variables: Only use this subset of NWP variables. Defaults to using all.
+        store_cache_size: If provided, wrap each zarr store in a LRU cache of that many bytes. This
+            avoids fetching the same chunks over and over when the data is on a mounted or remote
+            file system. On a local disk it mostly wastes memory.
 
         """
         if isinstance(paths_or_data, str):
             paths_or_data = [paths_or_data]
 
-        if isinstance(paths_or_data, xr.Dataset):
-            self._paths = None
-            raw_data = paths_or_data
-        else:
-            self._paths = paths_or_data
-            raw_data = self._open(paths_or_data)
+        self._store_cache_size = store_cache_size
+
         # We'll have to transform the lat/lon coordinates to the internal dataset's coordinate
         # system.
         self._coordinate_transformer = CoordinateTransformer(4326, coord_system)
@@ -93,6 +94,13 @@ class NwpDataSource:
         self._tolerance = tolerance
         self._variables = variables
 
+        if isinstance(paths_or_data, xr.Dataset):
+            self._paths = None
+            raw_data = paths_or_data
+        else:
+            self._paths = paths_or_data
+            raw_data = self._open(paths_or_data)
+
         self._data = self._prepare_data(raw_data)
         self.raw_data = raw_data
 
@@ -105,11 +113,30 @@ class NwpDataSource:
 
     def _open(self, paths: list[str]) -> xr.Dataset:
         _log.debug(f"Opening data {paths}")
+        stores: list[str] | list[zarr.storage.LRUStoreCache] = paths
+        if self._store_cache_size is not None:
+            if isinstance(paths, pathlib.Path):
+                paths = [paths]
+            stores = [
+                zarr.storage.LRUStoreCache(
+                    zarr.storage.FSStore(str(path)), max_size=self._store_cache_size
+                )
+                for path in paths
+            ]
         return xr.open_mfdataset(
-            paths,
+            stores,
             engine="zarr",
+            preprocess=self._preprocess,
         )
 
+    def _preprocess(self, data: xr.Dataset) -> xr.Dataset:
+        """Drop what we don't need from each file, before they get combined together."""
+        # Note that this is called before the renaming in `_prepare_data`.
+        data = data[[self._value_name]]
+        if self._variables is not None:
+            data = data.sel({self._variable_dim_name: self._variables})
+        return data
+
     def _prepare_data(self, data: xr.Dataset) -> xr.Dataset:
         # Rename the dimensions.
         rename_map: dict[str, str] = {}
@@ -294,6 +321,11 @@ class NwpDataSource:
         deltas = [t - init_time for t in timestamps]
 
         if self._filter_on_step:
+            if load:
+                # Read all the steps at once: that's typically one contiguous read per chunk, after
+                # which the (many, often repeated) nearest steps are picked in memory, instead of
+                # asking dask for a point-wise selection.
+                ds = ds.load()
             # Get the nearest prediction to what we are interested in.
             ds = ds.sel(step=deltas, method="nearest")
 
@@ -315,10 +347,13 @@ class NwpDataSource:
         # I'm not sure of the state contained in a `Dataset` object, so I make sure we don't save
         # it.
         del d["_data"]
+        # The zarr stores can hold a cache of all the chunks read so far.
+        d.pop("raw_data", None)
         return d
 
     def __setstate__(self, state):
         for key, value in state.items():
             setattr(self, key, value)
         assert self._paths is not None
-        self._data = self._prepare_data(self._open(self._paths))
+        self.raw_data = self._open(self._paths)
+        self._data = self._prepare_data(self.raw_data)
@@ -1,21 +1,26 @@
 import abc
+import collections
+import dataclasses
 import datetime
 import logging
+import os
 import pathlib
-from typing import TypeVar
+import pickle
+import tempfile
+import weakref
+from multiprocessing import shared_memory
 
+import numpy as np
 import xarray as xr
+import zarr
 
 from psp.typings import PvId, Timestamp
 from psp.utils.dates import to_pydatetime
+from psp.utils.hashing import naive_hash
 
 _ID = "pv_id"
 _TS = "ts"
 
-# https://peps.python.org/pep-0673/
-_Self = TypeVar("_Self", bound="PvDataSource")
-
-
 _log = logging.getLogger(__name__)
 
 
@@ -48,8 +53,8 @@ class PvDataSource(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def as_available_at(self: _Self, ts: Timestamp) -> _Self:
-        """Return a copy of the data source that will filter anything that was not available at
+    def as_available_at(self, ts: Timestamp) -> "PvDataSource":
+        """Return a view of the data source that will filter anything that was not available at
         `ts`.
 
         This is a intended as a safety mechanism when we want to make sure we can't use data after
@@ -75,20 +80,39 @@ def min_timestamp(a: Timestamp | None, b: Timestamp | None) -> Timestamp | None:
 
     `None` values are assumed to be greater always.
     """
-    if a is None:
-        if b is None:
-            return None
-        else:
-            return b
-    else:
-        # a is not None
-        if b is None:
-            return a
-        else:
-            return min(a, b)
+    values = [x for x in (a, b) if x is not None]
+    return min(values) if values else None
+
+
+def _to_datetime64(ts: Timestamp) -> np.datetime64:
+    # `np.datetime64` silently converts timezone-aware timestamps to UTC, whereas our timestamps are
+    # naive. Fail like xarray does instead of returning shifted data.
+    if getattr(ts, "tzinfo", None) is not None:
+        raise TypeError("Cannot compare tz-naive and tz-aware timestamps")
+    return np.datetime64(ts)
 
 
 class NetcdfPvDataSource(PvDataSource):
+    # Attributes set in `_prepare_data`, that we don't pickle.
+    _DATA_ATTRIBUTES = (
+        "_data",
+        "_cache",
+        "_pv_ids",
+        "_pv_id_list",
+        "_id_idx",
+        "_ts64",
+        "_ts_min",
+        "_ts_max",
+        "_power",
+        "_shm",
+        "_zpower",
+        "_zpower_prepared",
+        "_zpower_skip_reason",
+        "_zpower_pv_idx",
+        "_zpower_is_ts_first",
+        "_zpower_fill_value",
+    )
+
     def __init__(
         self,
         path_or_data: pathlib.Path | str | xr.Dataset,
@@ -97,11 +121,15 @@ class NetcdfPvDataSource(PvDataSource):
         rename: dict[str, str] | None = None,
         ignore_pv_ids: list[str] | None = None,
         lag_minutes: float = 0.0,
+        cache_size: int = 0,
+        eager: bool = False,
+        cache_dir: str | None = None,
+        share_memory: bool = False,
     ):
         """
         Arguments:
         ---------
-            filepath: File path of the netcdf file.
+            path_or_data: Path to the netcdf file or `.zarr` store, or the xarray dataset directly.
             timestamp_dim_name: Name for the timestamp dimensions in the dataset.
             id_dim_name: Name for the "id" dimensions in the dataset.
             rename: This is passed to `xarray` to rename any coordinates or variable.
@@ -110,6 +138,22 @@ class NetcdfPvDataSource(PvDataSource):
                 in practice. Concretely, this means that when we call `as_available_at`,
                 `lag_minutes` minutes will subtracted from the passed timestamp. When training, this
                 should be set to the expected delay before the PV data is available, in production.
+            cache_size: Number of `get` results to keep in memory, in a LRU cache. The cache is
+                shared with the data sources returned by `as_available_at`. Disabled by default:
+                only use it when the same windows are requested repeatedly, as every result is
+                loaded in memory.
+            eager: Load the whole dataset in memory when opening it. This makes `get` much faster
+                but should only be used when the data fits comfortably in memory. The "power"
+                variable is then stored as float32.
+            cache_dir: Only used when `eager` is set. If provided, the "power" variable is saved in
+                this directory as a raw float32 file, and memory-mapped from there the next time
+                the same data is loaded. This skips the reading and decompressing of the data and
+                lets the OS share it between processes. The cache is invalidated when the files of
+                the "power" variable are modified.
+            share_memory: Only used when `eager` is set. Put the "power" variable in shared memory.
+                Copies of the data source unpickled in other processes (for instance in
+                `DataLoader` workers) will then use that memory instead of loading the data again.
+                Copies unpickled after the original data source is gone load the data themselves.
         """
         if rename is None:
             rename = {}
@@ -119,23 +163,32 @@ class NetcdfPvDataSource(PvDataSource):
             raw_data = path_or_data
         else:
             self._path = path_or_data
-            raw_data = xr.open_dataset(self._path)
+            raw_data = self._open(self._path)
 
         self._timestamp_dim_name = timestamp_dim_name
         self._id_dim_name = id_dim_name
         self._rename = rename
         self._ignore_pv_ids = ignore_pv_ids
         self._lag_minutes = lag_minutes
+        self._cache_size = cache_size
+        self._eager = eager
+        self._cache_dir = pathlib.Path(cache_dir) if cache_dir else None
+        self._share_memory = share_memory
+        # See `_load_power`. Only the name of the shared memory is pickled: the memory itself might
+        # not exist anymore when we are unpickled.
+        self._shm_name: str | None = None
 
         self._prepare_data(raw_data)
 
-        self._set_max_ts(None)
-
-    def _set_max_ts(self, ts: Timestamp | None) -> None:
-        # See `as_available_at`.
-        self._max_ts = ts
+    def _open(self, path: pathlib.Path | str) -> xr.Dataset:
+        _log.debug(f"Opening data {path}")
+        if pathlib.Path(path).suffix == ".zarr":
+            # `chunks=None` keeps the arrays lazy without wrapping them in dask, which would only
+            # add overhead to the many small slices we do in `get`.
+            return xr.open_zarr(path, chunks=None)
+        return xr.open_dataset(path)
 
-    def _prepare_data(self, raw_dataset: xr.Dataset) -> None:
+    def _rename_map(self) -> dict[str, str]:
         # Xarray doesn't like trivial renamings so we build a mapping of what actually changes.
         rename_map: dict[str, str] = {}
 
@@ -145,11 +198,23 @@ class NetcdfPvDataSource(PvDataSource):
             rename_map[self._timestamp_dim_name] = _TS
 
         rename_map.update(self._rename)
+        return rename_map
+
+    def _raw_power_name(self) -> str:
+        """Name of the "power" variable in the raw data."""
+        return next((old for old, new in self._rename_map().items() if new == "power"), "power")
 
+    def _prepare_data(self, raw_dataset: xr.Dataset) -> None:
+        rename_map = self._rename_map()
         self._data = raw_dataset.rename(rename_map)
 
-        # We use `str` types for ids throughout.
-        self._data.coords[_ID] = self._data.coords[_ID].astype(str)
+        # We use `str` types for ids throughout. Avoid copying the ids when they already are.
+        ids = self._data.coords[_ID].values
+        if not (
+            ids.dtype.kind == "U"
+            or (ids.dtype.kind == "O" and all(isinstance(x, str) for x in ids))
+        ):
+            self._data.coords[_ID] = self._data.coords[_ID].astype(str)
 
         if self._ignore_pv_ids is not None:
             num_pvs_before = len(self._data.coords["pv_id"])
@@ -157,17 +222,279 @@ class NetcdfPvDataSource(PvDataSource):
             num_pvs = len(self._data.coords["pv_id"])
             _log.debug(f"Removed {num_pvs_before - num_pvs} PVs")
 
+        # We rely on the timestamps being sorted to slice them with `np.searchsorted` in `get`.
+        if not self._data.indexes[_TS].is_monotonic_increasing:
+            self._data = self._data.sortby(_TS)
+
+        # Going through xarray is slow for those, and they are needed all the time, so we cache
+        # them as plain python/numpy objects.
+        self._pv_ids = self._data.coords[_ID].values
+        self._pv_id_list: list[PvId] = self._pv_ids.tolist()
+        self._id_idx = {pv_id: i for i, pv_id in enumerate(self._pv_id_list)}
+        self._ts64 = self._data.coords[_TS].values.astype("datetime64[ns]")
+        # The timestamps are sorted so no need for a reduction.
+        self._ts_min: Timestamp | None = None
+        self._ts_max: Timestamp | None = None
+        if len(self._ts64) > 0:
+            self._ts_min = to_pydatetime(self._ts64[0])
+            self._ts_max = to_pydatetime(self._ts64[-1])
+
+        # Keep the power as a contiguous (pv_id, ts) array, for fast raw access in `get_raw`.
+        self._power: np.ndarray | None = None
+        self._shm: shared_memory.SharedMemory | None = None
+        if self._eager:
+            # Decompress everything once instead of for every call to `get`.
+            if "power" in self._data:
+                power = self._data["power"]
+                self._power = self._load_power()
+                self._data = self._data.drop_vars("power").load()
+                # The dataset uses the same memory as `self._power`.
+                self._data["power"] = xr.DataArray(
+                    self._power, dims=(_ID, _TS), attrs=power.attrs
+                ).transpose(*power.dims)
+            else:
+                self._data = self._data.load()
+
+        # See `get`.
+        self._cache: collections.OrderedDict[tuple, xr.Dataset] = collections.OrderedDict()
+
+        # Only needed when we are not eager, see `_get_raw`.
+        self._zpower: zarr.Array | None = None
+        self._zpower_prepared = False
+        # Why we could not use the zarr array directly, see `_get_raw`.
+        self._zpower_skip_reason = ""
+
+    def _load_power(self) -> np.ndarray:
+        """Load the "power" variable as a contiguous (pv_id, ts) float32 array."""
+        shape = (len(self._pv_id_list), len(self._ts64))
+
+        if self._shm_name is not None:
+            # We were unpickled, typically in a worker process: use the memory of the original data
+            # source instead of loading everything again.
+            try:
+                self._shm = shared_memory.SharedMemory(name=self._shm_name)
+            except FileNotFoundError:
+                _log.debug(f"Shared memory {self._shm_name} is gone, loading the PV power")
+                self._shm_name = None
+            else:
+                return np.ndarray(shape, dtype=np.float32, buffer=self._shm.buf)
+
+        if self._cache_dir is None or self._path is None:
+            power = self._read_power()
+        else:
+            power = self._load_cached_power()
+
+        if self._share_memory:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(power.nbytes, 1))
+            self._shm_name = self._shm.name
+            # Only the data source that created the shared memory frees it.
+            weakref.finalize(self, self._shm.unlink)
+            shared_power: np.ndarray = np.ndarray(shape, dtype=np.float32, buffer=self._shm.buf)
+            shared_power[:] = power
+            power = shared_power
+
+        return power
+
+    def _load_cached_power(self) -> np.ndarray:
+        """Load the "power" variable using the `cache_dir`.
+
+        The array is saved in the `cache_dir` the first time, and memory-mapped from there the next
+        times.
+        """
+        assert self._cache_dir is not None and self._path is not None
+        path = pathlib.Path(self._path)
+        hash_ = naive_hash(
+            (
+                path.resolve(),
+                self._power_mtime_ns(),
+                self._id_dim_name,
+                self._timestamp_dim_name,
+                self._rename,
+                self._ignore_pv_ids,
+            )
+        )
+        data_path = self._cache_dir / f"pv_{hash_:x}.f32"
+        meta_path = self._cache_dir / f"pv_{hash_:x}.pkl"
+        shape = (len(self._pv_id_list), len(self._ts64))
+
+        if data_path.exists() and meta_path.exists():
+            with open(meta_path, "rb") as f:
+                pv_id_list, ts64 = pickle.load(f)
+            # Sanity check, in case the data changed without its modification time changing.
+            if pv_id_list == self._pv_id_list and np.array_equal(ts64, self._ts64):
+                _log.debug(f"Using cached PV power {data_path}")
+                return np.memmap(data_path, dtype=np.float32, mode="r", shape=shape)
+
+        power = self._read_power()
+
+        # Write to temporary files first, so that we never leave half-written files around. Each
+        # file gets its own unique temporary file, as other processes might be doing the same.
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        data_fd, data_tmp = tempfile.mkstemp(dir=self._cache_dir)
+        meta_fd, meta_tmp = tempfile.mkstemp(dir=self._cache_dir)
+        try:
+            with open(data_fd, "wb") as f:
+                power.tofile(f)
+            with open(meta_fd, "wb") as f:
+                pickle.dump((self._pv_id_list, self._ts64), f, protocol=-1)
+            # The data file is only used when the metadata file exists, so it goes last.
+            os.replace(meta_tmp, meta_path)
+            os.replace(data_tmp, data_path)
+        finally:
+            for tmp in (data_tmp, meta_tmp):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        return power
+
+    def _power_mtime_ns(self) -> int:
+        """Last modification time of the files of the "power" variable."""
+        assert self._path is not None
+        path = pathlib.Path(self._path)
+        if path.suffix != ".zarr":
+            return path.stat().st_mtime_ns
+        # Rewriting chunks in place doesn't change the modification time of the store's directory,
+        # so we look at all the files of the array.
+        files = [p for p in (path / self._raw_power_name()).rglob("*") if p.is_file()]
+        return max((p.stat().st_mtime_ns for p in files), default=path.stat().st_mtime_ns)
+
+    def _read_power(self) -> np.ndarray:
+        # float32 is plenty for power values and halves the memory (and memory bandwidth).
+        # Missing values stay NaN.
+        return np.ascontiguousarray(
+            self._data["power"].transpose(_ID, _TS).values, dtype=np.float32
+        )
+
+    def _prepare_zarr_power(self) -> None:
+        """Keep a direct reference to the underlying `zarr.Array` for the "power" variable.
+
+        Going through xarray means re-reading the array's metadata for every chunk we read. When
+        the data comes from a zarr store, we keep the array around so that `_get_raw` can read it
+        directly.
+        """
+        self._zpower_prepared = True
+
+        if self._path is None or pathlib.Path(self._path).suffix != ".zarr":
+            self._zpower_skip_reason = "the data does not come from a .zarr store"
+            return
+
+        raw_dataset = self._open(self._path)
+        raw_name = self._raw_power_name()
+        if raw_name not in raw_dataset.data_vars:
+            self._zpower_skip_reason = f'there is no "{raw_name}" variable'
+            return
+
+        raw_var = raw_dataset[raw_name]
+        # We would have to replicate xarray's decoding.
+        if "scale_factor" in raw_var.encoding or "add_offset" in raw_var.encoding:
+            self._zpower_skip_reason = f'"{raw_name}" uses a scale_factor or add_offset'
+            return
+
+        # The timestamp indices in the store must match ours.
+        if not raw_dataset.indexes[self._timestamp_dim_name].is_monotonic_increasing:
+            self._zpower_skip_reason = "the timestamps in the store are not sorted"
+            return
+
+        try:
+            group = zarr.open_consolidated(str(self._path), mode="r")
+        except KeyError:
+            # The store doesn't have consolidated metadata.
+            group = zarr.open_group(str(self._path), mode="r")
+        self._zpower = group[raw_name]
+        self._zpower_is_ts_first = raw_var.dims[0] == self._timestamp_dim_name
+        self._zpower_fill_value = raw_var.encoding.get("_FillValue")
+
+        # Map our pv ids to their index in the store, which can be different when we ignore some.
+        raw_ids = raw_dataset.coords[self._id_dim_name].values.astype(str)
+        self._zpower_pv_idx = np.flatnonzero(np.isin(raw_ids, self._pv_ids))
+
+    def get_raw(self, pv_idx: int, i0: int, i1: int) -> np.ndarray:
+        """Get the "power" values as a numpy array, without any of the xarray overhead.
+
+        This uses the in-memory array when the data source is `eager`, and reads the zarr store
+        directly otherwise.
+
+        Arguments:
+        ---------
+            pv_idx: Index of the PV in `list_pv_ids()`.
+            i0: Index of the first timestamp.
+            i1: Index of the last timestamp (excluded).
+        """
+        if self._power is not None:
+            return self._power[pv_idx, i0:i1]
+        return self._get_raw(pv_idx, slice(i0, i1))
+
+    def _get_raw(self, pv_idx: int, ts_slice: slice) -> np.ndarray:
+        """Read the "power" values directly from the zarr store, bypassing xarray.
+
+        Arguments:
+        ---------
+            pv_idx: Index of the PV in `list_pv_ids()`.
+            ts_slice: Integer slice on the timestamp dimension.
+        """
+        if not self._zpower_prepared:
+            self._prepare_zarr_power()
+
+        if self._zpower is None:
+            raise RuntimeError(f"Raw access is not available: {self._zpower_skip_reason}")
+
+        idx = int(self._zpower_pv_idx[pv_idx])
+        if self._zpower_is_ts_first:
+            values = self._zpower[ts_slice, idx]
+        else:
+            values = self._zpower[idx, ts_slice]
+
+        if self._zpower_fill_value is not None:
+            values = np.where(values == self._zpower_fill_value, np.nan, values)
+
+        return values
+
     def get(
         self,
         pv_ids: list[PvId] | PvId,
         start_ts: Timestamp | None = None,
         end_ts: Timestamp | None = None,
     ) -> xr.Dataset:
-        end_ts = min_timestamp(self._max_ts, end_ts)
-        return self._data.sel(pv_id=pv_ids, ts=slice(start_ts, end_ts))
+        """See `PvDataSource.get`.
+
+        The returned datasets can be shared between calls and should not be modified in place.
+        """
+        # Find the integer indices ourselves: this is much faster than going through the
+        # label-based `.sel`.
+        i0, i1 = self._ts_slice(start_ts, end_ts)
+        idx: int | np.ndarray
+        if isinstance(pv_ids, str):
+            idx = self._id_idx[pv_ids]
+        else:
+            idx = np.fromiter((self._id_idx[p] for p in pv_ids), dtype=np.int64, count=len(pv_ids))
+
+        if self._cache_size <= 0:
+            return self._data.isel(pv_id=idx, ts=slice(i0, i1))
+
+        # Key on the rows we select, so that different bounds selecting the same data share the
+        # same entry.
+        key = (idx if isinstance(idx, int) else tuple(idx.tolist()), i0, i1)
+        data = self._cache.get(key)
+        if data is None:
+            data = self._data.isel(pv_id=idx, ts=slice(i0, i1)).load()
+            self._cache[key] = data
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return data
+
+    def _ts_slice(self, start_ts: Timestamp | None, end_ts: Timestamp | None) -> tuple[int, int]:
+        """Integer bounds of the timestamps between `start_ts` and `end_ts`, both inclusive."""
+        i0 = 0 if start_ts is None else int(np.searchsorted(self._ts64, _to_datetime64(start_ts)))
+        if end_ts is None:
+            i1 = len(self._ts64)
+        else:
+            i1 = int(np.searchsorted(self._ts64, _to_datetime64(end_ts), side="right"))
+        return i0, i1
 
     def list_pv_ids(self):
-        out = list(self._data.coords[_ID].values)
+        out = list(self._pv_id_list)
 
         if len(out) > 0:
             assert isinstance(out[0], PvId)
@@ -175,23 +502,27 @@ class NetcdfPvDataSource(PvDataSource):
         return out
 
     def min_ts(self):
-        ts = to_pydatetime(self._data.coords[_TS].min().values)  # type:ignore
-        return min_timestamp(ts, self._max_ts)
+        if self._ts_min is None:
+            raise self._no_timestamps_error()
+        return self._ts_min
 
     def max_ts(self):
-        ts = to_pydatetime(self._data.coords[_TS].max().values)  # type:ignore
-        return min_timestamp(ts, self._max_ts)
-
-    def as_available_at(self, ts: Timestamp) -> "NetcdfPvDataSource":
-        now = ts - datetime.timedelta(minutes=self._lag_minutes) - datetime.timedelta(seconds=1)
-        # We simply make a copy and change it's `max_ts`.
-        # Using `copy.copy` used __setstate__ and __getstate__, which we tampered with so we use our
-        # own implementation, which is inspired from the pickle doc:
-        # https://docs.python.org/3/library/pickle.html#pickling-class-instances
-        new_ds = NetcdfPvDataSource.__new__(NetcdfPvDataSource)
-        new_ds.__dict__.update(self.__dict__)
-        new_ds._set_max_ts(min_timestamp(self._max_ts, now))
-        return new_ds
+        if self._ts_max is None:
+            raise self._no_timestamps_error()
+        return self._ts_max
+
+    def _no_timestamps_error(self) -> ValueError:
+        name = self._path if self._path is not None else "the dataset"
+        return ValueError(f"There are no timestamps in {name}")
+
+    def as_available_at(self, ts: Timestamp) -> "PvDataSource":
+        # This is called for every sample so we don't copy anything: we return a light view that
+        # forwards everything to `self`.
+        return _AvailableAtView(self, self._available_until(ts))
+
+    def _available_until(self, ts: Timestamp) -> Timestamp:
+        """Last timestamp for which the data is available at time `ts`."""
+        return ts - datetime.timedelta(minutes=self._lag_minutes) - datetime.timedelta(seconds=1)
 
     def __getstate__(self):
         # Prevent pickling (potentially big) data sources when we don't have a path. Having a path
@@ -202,8 +533,9 @@ class NetcdfPvDataSource(PvDataSource):
             )
         d = self.__dict__.copy()
         # I'm not sure of the state contained in a `Dataset` object, so I make sure we don't save
-        # it.
-        del d["_data"]
+        # it. Everything we derived from it will be re-computed in `__setstate__`.
+        for key in self._DATA_ATTRIBUTES:
+            d.pop(key, None)
         return d
 
     def __setstate__(self, state):
@@ -211,7 +543,44 @@ class NetcdfPvDataSource(PvDataSource):
             setattr(self, key, value)
         # Only data sources with a path should have been pickled.
         assert self._path is not None
-        self._prepare_data(xr.open_dataset(self._path))
+        self._prepare_data(self._open(self._path))
 
     def list_data_variables(self) -> list[str]:
         return list(self._data.data_vars)
+
+
+@dataclasses.dataclass(frozen=True)
+class _AvailableAtView(PvDataSource):
+    """View on a `NetcdfPvDataSource` that filters everything after `until`.
+
+    See `PvDataSource.as_available_at`.
+    """
+
+    source: NetcdfPvDataSource
+    until: Timestamp
+
+    def get(
+        self,
+        pv_ids: list[PvId] | PvId,
+        start_ts: Timestamp | None = None,
+        end_ts: Timestamp | None = None,
+    ) -> xr.Dataset:
+        # This is called for every sample so we inline `min_timestamp(self.until, end_ts)`.
+        if end_ts is None or self.until < end_ts:
+            end_ts = self.until
+        return self.source.get(pv_ids, start_ts, end_ts)
+
+    def list_pv_ids(self) -> list[PvId]:
+        return self.source.list_pv_ids()
+
+    def min_ts(self) -> Timestamp:
+        return min(self.source.min_ts(), self.until)
+
+    def max_ts(self) -> Timestamp:
+        return min(self.source.max_ts(), self.until)
+
+    def as_available_at(self, ts: Timestamp) -> "PvDataSource":
+        return _AvailableAtView(self.source, min(self.until, self.source._available_until(ts)))
+
+    def list_data_variables(self) -> list[str]:
+        return self.source.list_data_variables()
@@ -13,9 +13,11 @@ from psp.models.regressors.decision_trees import SklearnRegressor
 from psp.typings import Horizons
 
 # _PREFIX = ""
+# Rechunked with one chunk per 16 PVs from "sme_no_stark.nc", using
+# `python psp/scripts/rechunk_pv.py sme_no_stark.nc sme_no_stark.zarr`.
 PV_DATA_PATH = (
     "/mnt/storage_b/data/ocf/solar_pv_nowcasting/nowcasting_dataset_pipeline/"
-    "PV/sme/v1/no_stark/sme_no_stark.nc"
+    "PV/sme/v1/no_stark/sme_no_stark.zarr"
 )
 # stark/sme_stark.nc"
 # no_stark/sme_no_stark.nc"
@@ -48,13 +50,22 @@ ECMWF_PATH = [
 ]
 
 
+@functools.lru_cache(maxsize=8)
+def _make_pv_data_source(path: str, **kwargs) -> NetcdfPvDataSource:
+    # Shared between all the `ExpConfig` instances so that we only open (and load) the data once.
+    return NetcdfPvDataSource(path, **kwargs)
+
+
 class ExpConfig(ExpConfigBase):
-    @functools.cache
     def get_pv_data_source(self):
-        return NetcdfPvDataSource(
+        return _make_pv_data_source(
             PV_DATA_PATH,
             # lag_minutes=60, # Lag for sites with Stark meters
             lag_minutes=2 * 24 * 60,  # Lag for sites without Stark meters
+            # The SME dataset is small enough to fit in memory.
+            eager=True,
+            # Keep a local copy of the power data, to avoid reading it from the mounted drive.
+            cache_dir=".pv_cache",
         )
 
     @functools.cache
@@ -84,6 +95,8 @@ class ExpConfig(ExpConfigBase):
                     ],
                     tolerance="168h",
                     lag_minutes=4 * 60,
+                    # The data is on a mounted drive: keep the recently used chunks in memory.
+                    store_cache_size=1 << 30,
                 ),
                 "EXC": NwpDataSource(
                     EXC_PATH,
@@ -277,8 +277,11 @@ class RecentHistoryModel(PvSiteModel):
         # When there is no power value in our data (which happens mainly when we
         # explicitely make tests without power data), we make up one with NaN values.
         if "power" not in _data:
+            # Note that we don't modify `_data` in place: it can be shared by the data source.
             shape = tuple(_data.dims.values())
-            _data["power"] = xr.DataArray(np.empty(shape) * np.nan, dims=tuple(_data.dims))
+            _data = _data.assign(
+                power=xr.DataArray(np.empty(shape) * np.nan, dims=tuple(_data.dims))
+            )
 
         data = _data["power"]
 
@@ -291,7 +294,7 @@ class RecentHistoryModel(PvSiteModel):
             and self._random_state is not None
             and self._random_state.random() < self._pv_dropout
         ):
-            data *= np.nan
+            data = data * np.nan
 
         coords = _data.coords
 
@@ -0,0 +1,58 @@
+"""Rechunk a netcdf/zarr PV data file into a zarr store with one chunk per group of PVs.
+
+`NetcdfPvDataSource.get` reads all the timestamps of a few PVs at a time. Chunking the data along
+the PV dimension (and not at all along the time dimension) means each call reads a single chunk.
+"""
+
+import argparse
+import pathlib
+
+import xarray
+
+
+def rechunk(
+    input: pathlib.Path,
+    output: pathlib.Path,
+    *,
+    id_dim_name: str,
+    pv_chunk_size: int,
+    engine: str | None = None,
+):
+    ds = xarray.open_dataset(input, engine=engine, chunks={})
+
+    # One chunk per `pv_chunk_size` PVs, and no chunking on the other dimensions.
+    chunks = {dim: -1 for dim in ds.dims}
+    chunks[id_dim_name] = pv_chunk_size
+    ds = ds.chunk(chunks)
+
+    # Otherwise `to_zarr` tries to use the chunks of the input file.
+    for var in ds.variables.values():
+        var.encoding.pop("chunks", None)
+        var.encoding.pop("preferred_chunks", None)
+
+    ds.to_zarr(output, mode="w-")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("input", help="path to the netcdf/zarr file to rechunk", type=pathlib.Path)
+    parser.add_argument("output", help="path to the output .zarr store", type=pathlib.Path)
+    parser.add_argument("--id-dim-name", help="name of the PV id dimension", default="pv_id")
+    parser.add_argument("--pv-chunk-size", help="number of PVs per chunk", type=int, default=16)
+    parser.add_argument("--engine", help="tell xarray what engine to use")
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):
+    rechunk(
+        args.input,
+        args.output,
+        id_dim_name=args.id_dim_name,
+        pv_chunk_size=args.pv_chunk_size,
+        engine=args.engine,
+    )
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    main(args)
@@ -1,3 +1,4 @@
+import pickle
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -22,9 +23,11 @@ LAT1 = 51
 LAT2 = 52
 
 
-@pytest.fixture(params=[27700, 4326])
+@pytest.fixture(params=[(27700, None), (4326, None), (27700, 1 << 20)])
 def nwp_data_sources(tmp_path, request):
-    coord_system: int = request.param
+    coord_system: int
+    store_cache_size: int | None
+    coord_system, store_cache_size = request.param
 
     lats = [LAT0, LAT1, LAT2]
     lons = [LON0, LON1, LON2]
@@ -66,7 +69,7 @@ def nwp_data_sources(tmp_path, request):
     path = tmp_path / "nwp_fixture.zarr"
     ds.to_zarr(path)
 
-    return NwpDataSource(path, coord_system=coord_system)
+    return NwpDataSource(path, coord_system=coord_system, store_cache_size=store_cache_size)
 
 
 def hours(x: float) -> timedelta:
@@ -197,3 +200,45 @@ def test_nwp_data_source_tolerance(nwp_data_sources):
     assert data is not None
     data = nwp_data_sources.get(now=now, timestamps=now, tolerance="24h")
     assert data is None
+
+
+def test_nwp_data_source_variables(tmp_path):
+    da = xr.DataArray(
+        data=np.arange(2 * 3).reshape(2, 3),
+        coords={"init_time": [T0, T1], "variable": ["a", "b", "c"]},
+    )
+    ds = xr.Dataset({"UKV": da, "other": da * 2})
+    path = tmp_path / "nwp.zarr"
+    ds.to_zarr(path)
+
+    nwp = NwpDataSource(
+        str(path), time_dim_name="init_time", value_name="UKV", variables=["c", "a"]
+    )
+    assert list(nwp._data.data_vars) == ["value"]
+    assert nwp.list_variables() == ["c", "a"]
+    assert nwp._data["value"].sel(time=T1).values.tolist() == [5, 3]
+
+
+def test_nwp_data_source_pickle_store_cache(tmp_path):
+    da = xr.DataArray(
+        data=np.random.random((1, 3, 100, 100)),
+        coords={
+            "time": [T0],
+            "step": [timedelta(0), timedelta(hours=1), timedelta(hours=2)],
+            "x": np.arange(100),
+            "y": np.arange(100),
+        },
+    )
+    path = tmp_path / "nwp.zarr"
+    xr.Dataset({"value": da}).to_zarr(path)
+
+    nwp = NwpDataSource(path, store_cache_size=1 << 30)
+    data = nwp.get(now=T0, timestamps=[T0, T1, T2])
+    assert data is not None
+
+    # The chunks cached by the zarr stores are not pickled.
+    s = pickle.dumps(nwp)
+    assert len(s) < 100_000
+
+    nwp2 = pickle.loads(s)
+    assert_array_equal(nwp2.get(now=T0, timestamps=[T0, T1, T2]).values, data.values)
@@ -1,11 +1,12 @@
+import gc
 import pickle
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 import numpy as np
 import pytest
 import xarray as xr
 
-from psp.data_sources.pv import NetcdfPvDataSource
+from psp.data_sources.pv import NetcdfPvDataSource, min_timestamp
 
 
 def _make_pv_data_xarray() -> xr.Dataset:
@@ -129,3 +130,231 @@ def test_non_path_pv_data_source_pickle_raises(tmp_path):
         with pytest.raises(RuntimeError) as e:
             pickle.dump(ds, f)
         assert "that were constructed using a path" in str(e)
+
+
+@pytest.mark.parametrize("eager", [False, True])
+@pytest.mark.parametrize("filename", ["pv_data.nc", "pv_data.zarr"])
+def test_pv_data_source_from_path(tmp_path, filename, eager):
+    d = _make_pv_data_xarray()
+    path = tmp_path / filename
+    if path.suffix == ".zarr":
+        d.to_zarr(path)
+    else:
+        d.to_netcdf(path)
+
+    ds = NetcdfPvDataSource(path, eager=eager)
+    assert ds.list_pv_ids() == ["1", "2", "3"]
+    assert ds.get(pv_ids="2", start_ts=datetime(2023, 1, 2))["power"].values.tolist() == [5, 6, 7]
+
+    # Pickling re-opens the data from the path.
+    ds2 = pickle.loads(pickle.dumps(ds))
+    assert ds2.get(pv_ids="2", end_ts=datetime(2023, 1, 2))["power"].values.tolist() == [4, 5]
+
+
+def test_pv_data_source_get_raw(tmp_path):
+    d = _make_pv_data_xarray()
+    path = tmp_path / "pv_data.zarr"
+    d.to_zarr(path)
+
+    ds = NetcdfPvDataSource(path, ignore_pv_ids=["2"])
+    assert ds.list_pv_ids() == ["1", "3"]
+    np.testing.assert_array_equal(ds._get_raw(1, slice(1, 3)), [9, 10])
+    np.testing.assert_array_equal(ds._get_raw(0, slice(None)), ds.get(pv_ids="1")["power"].values)
+
+
+def test_pv_data_source_get_raw_unavailable(tmp_path):
+    d = _make_pv_data_xarray().isel(ts=[1, 0, 2, 3])
+    path = tmp_path / "pv_data.zarr"
+    d.to_zarr(path)
+
+    ds = NetcdfPvDataSource(path)
+    with pytest.raises(RuntimeError, match="not sorted"):
+        ds.get_raw(0, 0, 2)
+
+
+@pytest.mark.parametrize(
+    "start_ts,end_ts,expected",
+    [
+        [None, None, [0, 1, 2, 3]],
+        [datetime(2023, 1, 2), None, [1, 2, 3]],
+        [None, datetime(2023, 1, 2), [0, 1]],
+        [datetime(2023, 1, 1, 12), datetime(2023, 1, 3, 12), [1, 2]],
+        [datetime(2022, 1, 1), datetime(2022, 1, 2), []],
+        [datetime(2024, 1, 1), None, []],
+    ],
+)
+def test_pv_data_source_get_ts_bounds(start_ts, end_ts, expected):
+    ds = NetcdfPvDataSource(_make_pv_data_xarray())
+    assert ds.get(pv_ids="1", start_ts=start_ts, end_ts=end_ts)["power"].values.tolist() == expected
+
+
+def test_pv_data_source_cache():
+    ds = NetcdfPvDataSource(_make_pv_data_xarray(), cache_size=2)
+
+    d1 = ds.get(pv_ids="1", start_ts=datetime(2023, 1, 2))
+    assert ds.get(pv_ids="1", start_ts=datetime(2023, 1, 2)) is d1
+
+    # The cache is shared with `as_available_at` but takes the `max_ts` into account.
+    ds2 = ds.as_available_at(datetime(2023, 1, 3))
+    d2 = ds2.get(pv_ids="1", start_ts=datetime(2023, 1, 2))
+    assert d2["power"].values.tolist() == [1]
+    assert ds.get(pv_ids="1", start_ts=datetime(2023, 1, 2)) is d1
+
+    # Pushes `d2` out of the cache.
+    ds.get(pv_ids=["1", "2"])
+    assert ds2.get(pv_ids="1", start_ts=datetime(2023, 1, 2)) is not d2
+
+    # Bounds that select the same rows share the same entry.
+    d3 = ds.get(pv_ids="2", start_ts=datetime(2023, 1, 2))
+    assert ds.get(pv_ids="2", start_ts=datetime(2023, 1, 1, 12)) is d3
+
+    # Arrays of ids can be used too.
+    d4 = ds.get(pv_ids=np.array(["1", "2"]))  # type: ignore[arg-type]
+    assert ds.get(pv_ids=["1", "2"]) is d4
+    assert d4["power"].values.tolist() == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+
+@pytest.mark.parametrize("eager", [False, True])
+def test_pv_data_source_get_raw_eager(tmp_path, eager):
+    d = _make_pv_data_xarray()
+    path = tmp_path / "pv_data.zarr"
+    d.to_zarr(path)
+
+    ds = NetcdfPvDataSource(path, eager=eager)
+    values = ds.get_raw(1, 1, 3)
+    np.testing.assert_array_equal(values, [5, 6])
+    if eager:
+        assert values.dtype == np.float32
+    # The zarr array is only needed, and opened, when we are not eager.
+    assert ds._zpower_prepared == (not eager)
+
+
+def test_pv_data_source_eager_float32():
+    ds = NetcdfPvDataSource(_make_pv_data_xarray(), eager=True)
+    power = ds.get(pv_ids=["1", "2"])["power"]
+    assert power.dtype == np.float32
+    # The dataset and the raw array share their memory.
+    assert np.shares_memory(ds._data["power"].values, ds._power)
+
+
+def test_pv_data_source_tz_aware_raises():
+    ds = NetcdfPvDataSource(_make_pv_data_xarray())
+    with pytest.raises(TypeError, match="tz-aware"):
+        ds.get(pv_ids="1", start_ts=datetime(2023, 1, 2, tzinfo=timezone.utc))
+    with pytest.raises(TypeError, match="tz-aware"):
+        ds.get(pv_ids="1", end_ts=datetime(2023, 1, 2, tzinfo=timezone.utc))
+
+
+def test_pv_data_source_no_timestamps():
+    d = _make_pv_data_xarray().isel(ts=slice(0, 0))
+    ds = NetcdfPvDataSource(d)
+    assert ds.get(pv_ids="1")["power"].size == 0
+    with pytest.raises(ValueError, match="no timestamps"):
+        ds.min_ts()
+    with pytest.raises(ValueError, match="no timestamps"):
+        ds.as_available_at(datetime(2023, 1, 1)).max_ts()
+
+
+def test_pv_data_source_as_available_at_twice():
+    ds = NetcdfPvDataSource(_make_pv_data_xarray(), lag_minutes=60)
+
+    ds2 = ds.as_available_at(datetime(2023, 1, 3)).as_available_at(datetime(2023, 1, 4))
+    assert ds2.max_ts() == datetime(2023, 1, 2, 22, 59, 59)
+
+    ds2 = ds.as_available_at(datetime(2023, 1, 4)).as_available_at(datetime(2023, 1, 3))
+    assert ds2.max_ts() == datetime(2023, 1, 2, 22, 59, 59)
+    assert ds2.list_pv_ids() == ["1", "2", "3"]
+    assert ds2.get(pv_ids="1")["power"].values.tolist() == [0, 1]
+
+
+def test_pv_data_source_get_pv_ids():
+    ds = NetcdfPvDataSource(_make_pv_data_xarray())
+
+    data = ds.get(pv_ids="2")
+    assert data["power"].dims == ("ts",)
+    assert data.coords["pv_id"].item() == "2"
+
+    data = ds.get(pv_ids=["3", "1"], end_ts=datetime(2023, 1, 1))
+    assert data.coords["pv_id"].values.tolist() == ["3", "1"]
+    assert data["power"].values.tolist() == [[8], [0]]
+
+
+@pytest.mark.parametrize(
+    "a,b,expected",
+    [
+        [None, None, None],
+        [datetime(2023, 1, 1), None, datetime(2023, 1, 1)],
+        [None, datetime(2023, 1, 1), datetime(2023, 1, 1)],
+        [datetime(2023, 1, 2), datetime(2023, 1, 1), datetime(2023, 1, 1)],
+    ],
+)
+def test_min_timestamp(a, b, expected):
+    assert min_timestamp(a, b) == expected
+
+
+def test_pv_data_source_cache_dir(tmp_path):
+    d = _make_pv_data_xarray()
+    path = tmp_path / "pv_data.zarr"
+    d.to_zarr(path)
+    cache_dir = tmp_path / "cache"
+
+    ds = NetcdfPvDataSource(path, eager=True, cache_dir=str(cache_dir))
+    assert not isinstance(ds._power, np.memmap)
+    assert len(list(cache_dir.iterdir())) == 2
+
+    ds = NetcdfPvDataSource(path, eager=True, cache_dir=str(cache_dir))
+    assert isinstance(ds._power, np.memmap)
+    assert ds.get(pv_ids="2", start_ts=datetime(2023, 1, 3))["power"].values.tolist() == [6, 7]
+    np.testing.assert_array_equal(ds.get(pv_ids=["1", "2", "3"])["power"].values, d["power"])
+
+    # Different options don't use the same cache.
+    ds = NetcdfPvDataSource(path, eager=True, cache_dir=str(cache_dir), ignore_pv_ids=["1"])
+    assert not isinstance(ds._power, np.memmap)
+    assert ds.get(pv_ids="2", start_ts=datetime(2023, 1, 3))["power"].values.tolist() == [6, 7]
+
+    # Rewriting the power in place invalidates the cache.
+    d["power"] += 100
+    d[["power"]].to_zarr(path, mode="r+")
+    ds = NetcdfPvDataSource(path, eager=True, cache_dir=str(cache_dir))
+    assert not isinstance(ds._power, np.memmap)
+    assert ds.get(pv_ids="2", start_ts=datetime(2023, 1, 3))["power"].values.tolist() == [106, 107]
+
+    # Only the data and metadata files are left.
+    assert len(list(cache_dir.iterdir())) == 6
+
+
+def test_pv_data_source_share_memory(tmp_path):
+    d = _make_pv_data_xarray()
+    path = tmp_path / "pv_data.nc"
+    d.to_netcdf(path)
+
+    ds = NetcdfPvDataSource(path, eager=True, share_memory=True)
+    ds2 = pickle.loads(pickle.dumps(ds))
+
+    assert ds._shm is not None and ds2._shm is not None
+    assert ds2._shm.name == ds._shm.name
+    assert "_shm" not in ds.__getstate__()
+    np.testing.assert_array_equal(ds2.get(pv_ids=["1", "2", "3"])["power"].values, d["power"])
+
+    # Both use the same memory.
+    assert ds._power is not None
+    ds._power[0, 0] = 123
+    assert ds2.get(pv_ids="1")["power"].values[0] == 123
+
+    # Once the original is gone, copies load the data themselves.
+    name = ds._shm.name
+    s = pickle.dumps(ds)
+    del ds
+    gc.collect()
+    ds3 = pickle.loads(s)
+    assert ds3._shm is not None and ds3._shm.name != name
+    np.testing.assert_array_equal(ds3.get(pv_ids=["1", "2", "3"])["power"].values, d["power"])
+
+
+@pytest.mark.parametrize("dtype", [int, str, object])
+def test_pv_data_source_pv_id_types(dtype):
+    d = _make_pv_data_xarray()
+    d.coords["pv_id"] = np.array([1, 2, 3]).astype(str).astype(dtype)
+    ds = NetcdfPvDataSource(d)
+    assert ds.list_pv_ids() == ["1", "2", "3"]
+    assert ds.get(pv_ids="2")["power"].values.tolist() == [4, 5, 6, 7]
@@ -0,0 +1,29 @@
+import argparse
+
+import xarray as xr
+
+from psp.data_sources.pv import NetcdfPvDataSource
+from psp.scripts.rechunk_pv import main
+
+
+def test_rechunk_pv(tmp_path):
+    output = tmp_path / "pv_data.zarr"
+    args = argparse.Namespace(
+        input="psp/tests/fixtures/pv_data.nc",
+        output=output,
+        id_dim_name="ss_id",
+        pv_chunk_size=1,
+        engine=None,
+    )
+    main(args)
+
+    ds = xr.open_zarr(output)
+    assert ds["generation_wh"].encoding["chunks"] == (1, 3660)
+
+    pv_data_source = NetcdfPvDataSource(
+        output,
+        id_dim_name="ss_id",
+        timestamp_dim_name="timestamp",
+        rename={"generation_wh": "power"},
+    )
+    assert pv_data_source.list_pv_ids() == ["8215", "8229"]